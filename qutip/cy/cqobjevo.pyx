@@ -1,4 +1,4 @@
-#cython: language_level=3
+#cython: language_level=3, wraparound=True
 # distutils: language = c++
 # This file is part of QuTiP: Quantum Toolbox in Python.
 #
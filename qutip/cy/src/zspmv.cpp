@@ -32,8 +32,21 @@
 //#############################################################################
 #include <complex>
 
+// With GCC on x86-64 glibc systems, build extra copies of the kernel for
+// newer instruction sets and let the dynamic loader pick the best one for the
+// running CPU, so portable builds still get AVX2/AVX-512 code where available.
+#if defined(__GNUC__) && !defined(__clang__) && __GNUC__ >= 8 \
+    && defined(__x86_64__) && defined(__GLIBC__)
+#define QUTIP_TARGET_CLONES \
+    __attribute__((target_clones("default", "arch=haswell", \
+                                  "arch=skylake-avx512")))
+#else
+#define QUTIP_TARGET_CLONES
+#endif
+
 #if defined(__GNUC__) && defined(__SSE3__) // Using GCC or CLANG and SSE3
 #include <pmmintrin.h>
+QUTIP_TARGET_CLONES
 void zspmvpy(const std::complex<double> * __restrict__ data, const int * __restrict__ ind,
             const int * __restrict__ ptr,
             const std::complex<double> * __restrict__ vec, const std::complex<double> a,
@@ -70,6 +83,7 @@ void zspmvpy(const std::complex<double> * __restrict__ data, const int * __restr
     }
 }
 #elif defined(__GNUC__) // Using GCC or CLANG but no SSE3
+QUTIP_TARGET_CLONES
 void zspmvpy(const std::complex<double> * __restrict__ data, const int * __restrict__ ind,
             const int * __restrict__ ptr,
             const std::complex<double> * __restrict__ vec, const std::complex<double> a,
@@ -77,17 +91,28 @@ void zspmvpy(const std::complex<double> * __restrict__ data, const int * __restr
 {
     size_t row, jj;
     unsigned int row_start, row_end;
-    std::complex<double> dot;
+    double dot_re, dot_im;
     for (row=0; row < nrows; row++)
     {
-        dot = 0;
+        dot_re = 0;
+        dot_im = 0;
         row_start = ptr[row];
         row_end = ptr[row+1];
+        // The real and imaginary parts are accumulated separately so that
+        // the reduction can be vectorised (std::complex is not a valid
+        // OpenMP reduction type).  This needs only -fopenmp-simd, not the
+        // OpenMP runtime.
+        #pragma omp simd reduction(+:dot_re,dot_im)
         for (jj=row_start; jj <row_end; jj++)
         {
-            dot += data[jj]*vec[ind[jj]];
+            const double data_re = std::real(data[jj]);
+            const double data_im = std::imag(data[jj]);
+            const double vec_re = std::real(vec[ind[jj]]);
+            const double vec_im = std::imag(vec[ind[jj]]);
+            dot_re += data_re*vec_re - data_im*vec_im;
+            dot_im += data_re*vec_im + data_im*vec_re;
         }
-        out[row] += a*dot;
+        out[row] += a*std::complex<double>(dot_re, dot_im);
     }
 }
 #elif defined(_MSC_VER) && defined(__AVX__) // Visual Studio with AVX
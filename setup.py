@@ -1,20 +1,55 @@
 #!/usr/bin/env python
 
 import collections
+import functools
+import hashlib
+import json
 import os
-import pathlib
+import platform
 import re
 import subprocess
 import sys
 import sysconfig
+import tempfile
 import warnings
 
 # Required third-party imports, must be specified in pyproject.toml.
 from setuptools import setup, Extension
-import distutils.sysconfig
+from setuptools.command.build_ext import build_ext as _build_ext
+from setuptools.errors import CompileError, LinkError
+try:
+    from setuptools.modified import newer_group
+except ImportError:
+    # setuptools < 69
+    from setuptools.dep_util import newer_group
 import numpy as np
 from Cython.Build import cythonize
-from Cython.Distutils import build_ext
+
+# Modules whose extra C++ sources contain the hot sparse matrix-vector loops.
+# Only these are built with aggressive loop unrolling, which would otherwise
+# just bloat every Cython-generated wrapper.
+_HOT_UNROLL_MODULES = {'qutip.cy.spmatfuncs', 'qutip.cy.openmp.parfuncs'}
+
+# Instruction-set flags for GCC-like compilers, for each value of the 'arch'
+# option, and the equivalent MSVC `/arch` targets.  'generic' has no MSVC
+# target so that the compiler's baseline is used, and 'native' is resolved to
+# the detected host instruction set for MSVC, which has no such option.
+_GCC_ARCH_FLAGS = {
+    'generic': [],
+    'sse2': [],
+    'avx2': ['-mavx2', '-mfma', '-mtune=haswell'],
+    'avx512f': ['-mavx512f', '-mavx2', '-mfma', '-mtune=skylake-avx512'],
+    'native': ['-march=native', '-mtune=native'],
+}
+_MSVC_ARCH = {'sse2': 'SSE2', 'avx2': 'AVX2', 'avx512f': 'AVX512'}
+
+# Valid PEP 440 public version identifiers, as written in the VERSION file.
+_VERSION_RE = re.compile(
+    r'\d+(\.\d+)*((a|b|rc)\d+)?(\.post\d+)?(\.dev\d+)?', re.A,
+)
+
+# A full git commit hash, as found in .git/HEAD or a ref file.
+_GIT_SHA_RE = re.compile(r'[0-9a-f]{40}')
 
 
 def process_options():
@@ -26,13 +61,31 @@ def process_options():
             that this setup.py file is contained in.
         'release': bool
             Is this a release build (True) or a local development build (False)
-        'openmp': bool
+        'openmp': bool or None
             Should we build our OpenMP extensions and attempt to link in OpenMP
-            libraries?
+            libraries?  If None, this is decided at build time by testing
+            whether the compiler supports OpenMP.
+        'lto': bool
+            Should we compile and link with link-time optimisation?
+        'arch': str
+            The instruction set to compile for; see `_determine_arch`.
+        'jobs': int
+            The number of parallel jobs to use for Cython translation and for
+            compiling the extension modules.
+        'cython_cache': str
+            Base directory in which Cython caches its generated C++ files, or
+            an empty string to disable the cache.  See `_cython_cache_dir`.
+        'cython_directives': dict
+            Global compiler directives passed to Cython.  Individual files can
+            override these with a '# cython: ...' header comment.
         'cflags': list of str
             Flags to be passed to the C++ compiler.
         'ldflags': list of str
             Flags to be passed to the linker.
+        'openmp_cflags', 'openmp_ldflags': list of str
+            Additional compiler and linker flags for the OpenMP extensions.
+        'unroll_cflags': list of str
+            Additional compiler flags for the modules with hot inner loops.
         'include': list of str
             Additional directories to be added to the header files include
             path.  These files will be detected by Cython as dependencies, so
@@ -43,14 +96,17 @@ def process_options():
     options['rootdir'] = os.path.dirname(os.path.abspath(__file__))
     options = _determine_user_arguments(options)
     options = _determine_version(options)
+    options = _determine_arch(options)
     options = _determine_compilation_options(options)
+    options = _determine_cython_directives(options)
     return options
 
 
 def _determine_user_arguments(options):
     """
-    Add the 'release' and 'openmp' options to the collection, based on the
-    passed command-line arguments or environment variables.
+    Add the 'release', 'openmp', 'lto', 'jobs' and 'cython_cache' options to
+    the collection, based on the passed command-line arguments or environment
+    variables.
     """
     options['release'] = (
         '--release' in sys.argv
@@ -58,26 +114,45 @@ def _determine_user_arguments(options):
     )
     if '--release' in sys.argv:
         sys.argv.remove('--release')
-    options['openmp'] = (
+    # OpenMP support is detected automatically for local builds.  Release
+    # builds must opt in, so that distributed binaries do not suddenly gain a
+    # dependency on the OpenMP runtime.
+    if (
         '--with-openmp' in sys.argv
         or bool(os.environ.get('CI_QUTIP_WITH_OPENMP'))
-    )
+    ):
+        options['openmp'] = True
+    else:
+        options['openmp'] = False if options['release'] else None
     if "--with-openmp" in sys.argv:
         sys.argv.remove("--with-openmp")
+    # Link-time optimisation is on by default for release builds, and can be
+    # toggled either way with QUTIP_ENABLE_LTO=1 or QUTIP_ENABLE_LTO=0.
+    lto = os.environ.get('QUTIP_ENABLE_LTO')
+    options['lto'] = (
+        options['release'] if lto is None
+        else lto not in ('', '0')
+    )
+    # Parallel builds can be turned off by setting QUTIP_BUILD_JOBS=1.
+    options['jobs'] = int(
+        os.environ.get('QUTIP_BUILD_JOBS') or os.cpu_count() or 1
+    )
+    # Cython keys its cache on file contents rather than timestamps, so it
+    # stays valid across fresh checkouts (e.g. on CI).  QUTIP_CYTHON_CACHE=""
+    # turns it off.
+    options['cython_cache'] = os.environ.get(
+        'QUTIP_CYTHON_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'qutip', 'cython'),
+    )
     return options
 
 
 def _determine_compilation_options(options):
     """
     Add additional options specific to C/C++ compilation.  These are 'cflags',
-    'ldflags' and 'include'.
-    """
-    # Remove -Wstrict-prototypes from the CFLAGS variable that the Python build
-    # process uses in addition to user-specified ones; the flag is not valid
-    # for C++ compiles, but CFLAGS gets appended to those compiles anyway.
-    config = distutils.sysconfig.get_config_vars()
-    if "CFLAGS" in config:
-        config["CFLAGS"] = config["CFLAGS"].replace("-Wstrict-prototypes", "")
+    'ldflags', 'openmp_cflags', 'openmp_ldflags', 'unroll_cflags' and
+    'include'.
+    """
     options['cflags'] = []
     options['ldflags'] = []
     options['include'] = [np.get_include()]
@@ -85,23 +160,184 @@ def _determine_compilation_options(options):
         sysconfig.get_platform().startswith("win")
         and os.environ.get('MSYSTEM') is None
     ):
-        # Visual Studio
-        options['cflags'].extend(['/w', '/Ox'])
-        if options['openmp']:
-            options['cflags'].append('/openmp')
+        # Visual Studio.  `/O2` is the highest optimisation level MSVC
+        # supports.  The `/arch` target follows the 'arch' option, but can be
+        # set directly (e.g. to AVX2) with the QUTIP_MSVC_ARCH environment
+        # variable.
+        options['cflags'].extend(['/w', '/O2'])
+        arch = os.environ.get('QUTIP_MSVC_ARCH')
+        if arch is None:
+            isa = options['arch']
+            if isa == 'native':
+                isa = _detect_host_isa()
+            arch = _MSVC_ARCH.get(isa)
+        if arch:
+            options['cflags'].append('/arch:' + arch.upper())
+        options['openmp_cflags'] = ['/openmp']
+        options['openmp_ldflags'] = []
+        options['unroll_cflags'] = []
+        if options['lto']:
+            options['cflags'].append('/GL')
+            options['ldflags'].append('/LTCG')
     else:
         # Everything else
-        options['cflags'].extend(['-w', '-O3', '-funroll-loops'])
+        options['cflags'].extend([
+            '-w', '-O3',
+            # The FMA-enablement subset of -ffast-math.  These keep IEEE
+            # semantics for finite inputs and still propagate NaN and inf,
+            # which the solvers rely on, so do not add -ffinite-math-only or
+            # -fassociative-math here.
+            '-ffp-contract=fast', '-fno-trapping-math', '-fno-math-errno',
+            # Honour `#pragma omp simd` without linking the OpenMP runtime.
+            '-fopenmp-simd',
+        ])
+        options['cflags'].extend(_GCC_ARCH_FLAGS[options['arch']])
+        options['openmp_cflags'] = ['-fopenmp']
+        options['openmp_ldflags'] = ['-fopenmp']
+        options['unroll_cflags'] = ['-funroll-loops', '-funroll-all-loops']
+        if options['lto']:
+            options['cflags'].append('-flto')
+            options['ldflags'].append('-flto')
+            if not sysconfig.get_platform().startswith("macos"):
+                # Semantic interposition is an ELF concept; Apple's linker
+                # already binds calls within a library directly.
+                options['cflags'].append('-fno-semantic-interposition')
+                options['ldflags'].append('-fno-semantic-interposition')
     if sysconfig.get_platform().startswith("macos"):
         # These are needed for compiling on OSX 10.14+
         options['cflags'].append('-mmacosx-version-min=10.9')
         options['ldflags'].append('-mmacosx-version-min=10.9')
-        if options['openmp']:
-            options['cflags'].append('-fopenmp')
-            options['ldflags'].append('-fopenmp')
     return options
 
 
+def _determine_cython_directives(options):
+    """
+    Add the 'cython_directives' option.  By default we turn off the bounds,
+    negative-index and zero-division checks globally, since our Cython code is
+    almost all tight numerical loops.  Setting the environment variable
+    QUTIP_CYTHON_SAFE=1 keeps Cython's safe defaults, which is useful when
+    debugging a crash in an extension module.  Changing the directives forces
+    every file to be Cythonised again; see `create_extension_modules`.
+    """
+    options['cython_directives'] = {'language_level': 3}
+    if not os.environ.get('QUTIP_CYTHON_SAFE'):
+        options['cython_directives'].update({
+            'boundscheck': False,
+            'wraparound': False,
+            'cdivision': True,
+            'initializedcheck': False,
+            'nonecheck': False,
+        })
+    return options
+
+
+def _determine_arch(options):
+    """
+    Add the 'arch' option, which is the instruction set to compile for.  This
+    is taken from the QUTIP_ARCH environment variable if it is set, and is one
+    of
+        'generic'
+            Target the compiler's baseline architecture.  This is the only
+            safe choice for distributed binaries.
+        'sse2', 'avx2', 'avx512f'
+            Target x86-64 processors with (at least) these extensions.
+        'native'
+            Target the processor of the machine doing the build.
+    If QUTIP_ARCH is not set, release builds and builds running under
+    cibuildwheel use 'generic', and all other builds use the best instruction
+    set that the build machine supports.
+    """
+    arch = os.environ.get('QUTIP_ARCH')
+    if arch is None:
+        if options['release'] or os.environ.get('CIBUILDWHEEL') == '1':
+            arch = 'generic'
+        else:
+            arch = _detect_host_isa() or 'generic'
+    arch = arch.lower()
+    if arch not in _GCC_ARCH_FLAGS:
+        raise ValueError("invalid QUTIP_ARCH: " + arch)
+    options['arch'] = arch
+    return options
+
+
+def _detect_host_isa():
+    """
+    Find the best of the instruction sets 'sse2', 'avx2' and 'avx512f' that
+    the build machine supports, or None if it is not an x86-64 machine or we
+    cannot tell.  This is deliberately not cached, since a source tree on
+    shared storage may be built from several different machines.
+    """
+    if platform.machine().lower() not in ('x86_64', 'amd64'):
+        return None
+    if sys.platform.startswith('linux'):
+        return _detect_isa_linux()
+    if sys.platform == 'darwin':
+        return _detect_isa_macos()
+    if sys.platform == 'win32':
+        return _detect_isa_windows()
+    return None
+
+
+def _isa_from_features(features):
+    """
+    Get the best supported instruction set from a set of lower-case CPU
+    feature names.
+    """
+    if 'avx512f' in features:
+        return 'avx512f'
+    if 'avx2' in features and 'fma' in features:
+        return 'avx2'
+    if 'sse2' in features:
+        return 'sse2'
+    return None
+
+
+def _detect_isa_linux():
+    """Detect the host instruction set from /proc/cpuinfo."""
+    try:
+        with open('/proc/cpuinfo', 'r') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('flags'):
+                    return _isa_from_features(set(line.split()))
+    except OSError:
+        pass
+    return None
+
+
+def _detect_isa_macos():
+    """Detect the host instruction set from the CPU features in sysctl."""
+    try:
+        sysctl = subprocess.run(
+            ('sysctl', '-n', 'machdep.cpu.features',
+             'machdep.cpu.leaf7_features'),
+            check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    features = sysctl.stdout.decode(sys.stdout.encoding).lower().split()
+    return _isa_from_features(set(features))
+
+
+def _detect_isa_windows():
+    """
+    Detect the host instruction set by asking Windows, which has already run
+    CPUID, rather than compiling and running a probe of our own.  The codes
+    are the PF_*_INSTRUCTIONS_AVAILABLE constants from winnt.h; older versions
+    of Windows report the newer features as absent.
+    """
+    import ctypes
+    is_present = ctypes.windll.kernel32.IsProcessorFeaturePresent
+    features = {
+        name for name, code in [('sse2', 10), ('avx2', 40), ('avx512f', 41)]
+        if is_present(code)
+    }
+    if 'avx2' in features:
+        # Every processor with AVX2 also has FMA.
+        features.add('fma')
+    return _isa_from_features(features)
+
+
 def _determine_version(options):
     """
     Adds the 'short_version' and 'version' options.
@@ -118,30 +354,89 @@ def _determine_version(options):
     version_filename = os.path.join(options['rootdir'], 'VERSION')
     with open(version_filename, "r") as version_file:
         version = options['short_version'] = version_file.read().strip()
-    VERSION_RE = r'\d+(\.\d+)*((a|b|rc)\d+)?(\.post\d+)?(\.dev\d+)?'
-    if re.fullmatch(VERSION_RE, version, re.A) is None:
+    if _VERSION_RE.fullmatch(version) is None:
         raise ValueError("invalid version: " + version)
     if not options['release']:
         version += "+"
-        try:
-            git_out = subprocess.run(
-                ('git', 'rev-parse', '--verify', '--short=7', 'HEAD'),
-                check=True,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            )
-            git_hash = git_out.stdout.decode(sys.stdout.encoding).strip()
-            version += git_hash or "nogit"
-        except subprocess.CalledProcessError:
-            version += "nogit"
+        git_hash = _read_git_hash(options['rootdir'])
+        if git_hash is not None:
+            version += git_hash
+        else:
+            version += _run_git_hash()
     options['version'] = version
     return options
 
 
+def _read_git_hash(rootdir):
+    """
+    Get the short hash of the current git commit by reading the repository
+    files directly, which avoids starting a git process.  Returns None if the
+    hash could not be determined this way, for example if there is no
+    repository or it is in a layout we do not understand.
+    """
+    git_dir = os.path.join(rootdir, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            # Worktrees and submodules have a '.git' file pointing elsewhere.
+            with open(git_dir, 'r') as git_file:
+                contents = git_file.read().strip()
+            if not contents.startswith('gitdir: '):
+                return None
+            git_dir = os.path.join(rootdir, contents[len('gitdir: '):])
+        # Worktrees keep their own HEAD, but share refs with the main
+        # repository, which is named in the 'commondir' file.
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'r') as file:
+                common_dir = os.path.join(git_dir, file.read().strip())
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as head_file:
+            head = head_file.read().strip()
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            head = None
+            for directory in (git_dir, common_dir):
+                ref_filename = os.path.join(directory, *ref.split('/'))
+                if os.path.isfile(ref_filename):
+                    with open(ref_filename, 'r') as ref_file:
+                        head = ref_file.read().strip()
+                    break
+            else:
+                packed_filename = os.path.join(common_dir, 'packed-refs')
+                with open(packed_filename, 'r') as packed_file:
+                    for line in packed_file:
+                        parts = line.split()
+                        if len(parts) == 2 and parts[1] == ref:
+                            head = parts[0]
+                            break
+    except OSError:
+        return None
+    if head is None or _GIT_SHA_RE.fullmatch(head) is None:
+        return None
+    return head[:7]
+
+
+def _run_git_hash():
+    """
+    Get the short hash of the current git commit by asking git, or 'nogit' if
+    that fails.
+    """
+    try:
+        git_out = subprocess.run(
+            ('git', 'rev-parse', '--verify', '--short=7', 'HEAD'),
+            check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    except subprocess.CalledProcessError:
+        return "nogit"
+    return git_out.stdout.decode(sys.stdout.encoding).strip() or "nogit"
+
+
 def create_version_py_file(options):
     """
     Generate and write out the file qutip/version.py, which is used to produce
     the '__version__' information for the module.  This function will overwrite
-    an existing file at that location.
+    an existing file at that location, but only if its contents would change,
+    so that no-op rebuilds do not make it look modified.
     """
     filename = os.path.join(options['rootdir'], 'qutip', 'version.py')
     content = "\n".join([
@@ -149,18 +444,25 @@ def create_version_py_file(options):
         f"short_version = '{options['short_version']}'",
         f"version = '{options['version']}'",
         f"release = {options['release']}",
-    ])
+    ]) + "\n"
+    try:
+        with open(filename, 'r') as file:
+            if file.read() == content:
+                return
+    except OSError:
+        pass
     with open(filename, 'w') as file:
-        print(content, file=file)
+        file.write(content)
 
 
+@functools.lru_cache()
 def _extension_extra_sources():
     """
     Get a mapping of {module: extra_sources} for all modules to be built.  The
     module is the fully qualified Python module (e.g. 'qutip.cy.spmatfuncs'),
     and extra_sources is a list of strings of relative paths to files.  If no
     extra sources are known for a given module, the mapping will return an
-    empty list.
+    empty list.  The result is shared between calls, so must not be modified.
     """
     # For typing brevity we specify sources in Unix-style string form, then
     # normalise them into the OS-specific form later.
@@ -171,26 +473,86 @@ def _extension_extra_sources():
     out = collections.defaultdict(list)
     for module, sources in extra_sources.items():
         # Normalise the sources into OS-specific form.
-        out[module] = [str(pathlib.Path(source)) for source in sources]
+        out[module] = [source.replace('/', os.sep) for source in sources]
     return out
 
 
+def _find_pyx_files(options):
+    """
+    Get a list of (path, module) pairs for every .pyx file in the qutip
+    package, where path is relative to the root directory and module is the
+    fully qualified Python module it builds (e.g. 'qutip.cy.spmatfuncs').
+
+    '__pycache__' directories are never descended into, since they change
+    whenever bytecode is written.  If we are definitely not building the
+    OpenMP extensions, 'openmp' directories are skipped too.
+
+    The result is cached in build/.pyx_manifest along with the modification
+    times of every directory searched.  Adding, removing or renaming a file
+    always updates the modification time of its directory, so on a rebuild we
+    only need to stat the directories rather than list them all.
+    """
+    root = options['rootdir']
+    skip_openmp = options['openmp'] is False
+    manifest_filename = os.path.join(root, 'build', '.pyx_manifest')
+    try:
+        with open(manifest_filename, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['skip_openmp'] == skip_openmp and all(
+            os.stat(os.path.join(root, directory)).st_mtime_ns == mtime
+            for directory, mtime in manifest['directories'].items()
+        ):
+            return manifest['pyx_files']
+    except (OSError, ValueError, KeyError):
+        pass
+    skip_directories = {'__pycache__'}
+    if skip_openmp:
+        skip_directories.add('openmp')
+    directories = {}
+    pyx_files = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, 'qutip')):
+        dirnames[:] = [
+            name for name in dirnames if name not in skip_directories
+        ]
+        directory = os.path.relpath(dirpath, root)
+        directories[directory] = os.stat(dirpath).st_mtime_ns
+        for filename in filenames:
+            if not filename.endswith('.pyx'):
+                continue
+            pyx_file = os.path.join(directory, filename)
+            # The module name is the same as the folder structure, but with
+            # dots in place of separators ('/' or '\'), and without the '.pyx'
+            # extension.
+            pyx_module = ".".join(pyx_file.split(os.sep))[:-4]
+            pyx_files.append([pyx_file, pyx_module])
+    try:
+        os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+        with open(manifest_filename, 'w') as manifest_file:
+            json.dump({
+                'skip_openmp': skip_openmp,
+                'directories': directories,
+                'pyx_files': pyx_files,
+            }, manifest_file)
+    except OSError:
+        # The cache is only an optimisation, so a read-only tree is fine.
+        pass
+    return pyx_files
+
+
 def create_extension_modules(options):
     """
     Discover and Cythonise all extension modules that need to be built.  These
     are returned so they can be passed into the setup command.
     """
     out = []
-    root = pathlib.Path(options['rootdir'])
-    pyx_files = set(root.glob('qutip/**/*.pyx'))
-    if not options['openmp']:
-        pyx_files -= set(root.glob('qutip/**/openmp/**/*.pyx'))
     extra_sources = _extension_extra_sources()
+    include_dirs = options['include']
+    # File-name prefixes of the time-dependent coefficients that QuTiP
+    # generates at runtime.
+    generated_prefixes = ('cqobjevo_compiled_coeff_', 'qtcoeff_')
     # Add Cython files from qutip
-    for pyx_file in pyx_files:
-        pyx_file = pyx_file.relative_to(root)
-        pyx_file_str = str(pyx_file)
-        if 'compiled_coeff' in pyx_file_str or 'qtcoeff_' in pyx_file_str:
+    for pyx_file_str, pyx_module in _find_pyx_files(options):
+        if os.path.basename(pyx_file_str).startswith(generated_prefixes):
             # In development (at least for QuTiP ~4.5 and ~5.0) sometimes the
             # Cythonised time-dependent coefficients would get dropped in the
             # qutip directory if you weren't careful - this is just trying to
@@ -200,17 +562,199 @@ def create_extension_modules(options):
                 + pyx_file_str
             )
             continue
-        # The module name is the same as the folder structure, but with dots in
-        # place of separators ('/' or '\'), and without the '.pyx' extension.
-        pyx_module = ".".join(pyx_file.parts)[:-4]
-        pyx_sources = [pyx_file_str] + extra_sources[pyx_module]
+        pyx_sources = [pyx_file_str] + extra_sources.get(pyx_module, [])
+        cflags, ldflags = options['cflags'], options['ldflags']
+        if _is_openmp_module(pyx_module):
+            cflags = cflags + options['openmp_cflags']
+            ldflags = ldflags + options['openmp_ldflags']
+        if pyx_module in _HOT_UNROLL_MODULES:
+            cflags = cflags + options['unroll_cflags']
         out.append(Extension(pyx_module,
                              sources=pyx_sources,
-                             include_dirs=options['include'],
-                             extra_compile_args=options['cflags'],
-                             extra_link_args=options['ldflags'],
+                             include_dirs=include_dirs,
+                             extra_compile_args=cflags,
+                             extra_link_args=ldflags,
                              language='c++'))
-    return cythonize(out)
+    # Cython only re-translates a file if it is newer than its output, but
+    # changing the global directives (e.g. with QUTIP_CYTHON_SAFE) touches no
+    # files, so we record the directives of the last build and force a full
+    # re-translation if they have changed.  With no record, we only need to
+    # force if there is already generated code of unknown origin in the tree;
+    # forcing also bypasses Cython's cache, so we avoid it on fresh checkouts.
+    directives_filename = os.path.join(
+        options['rootdir'], 'build', '.cython_directives',
+    )
+    try:
+        with open(directives_filename, 'r') as directives_file:
+            previous_directives = json.load(directives_file)
+    except (OSError, ValueError):
+        previous_directives = None
+    directives_changed = previous_directives != options['cython_directives']
+    if previous_directives is None:
+        force = any(
+            os.path.exists(os.path.join(
+                options['rootdir'], extension.sources[0][:-4] + '.cpp',
+            ))
+            for extension in out
+        )
+    else:
+        force = directives_changed
+    extensions = cythonize(out,
+                           nthreads=options['jobs'],
+                           cache=_cython_cache_dir(options),
+                           force=force,
+                           compiler_directives=options['cython_directives'])
+    if directives_changed:
+        try:
+            os.makedirs(os.path.dirname(directives_filename), exist_ok=True)
+            with open(directives_filename, 'w') as directives_file:
+                json.dump(options['cython_directives'], directives_file)
+        except OSError:
+            pass
+    return extensions
+
+
+def _cython_cache_dir(options):
+    """
+    Get the directory to pass to `cythonize` as its cache, or False to disable
+    the cache.  Cython's cache key does not include the compiler directives, so
+    each set of directives gets its own subdirectory; otherwise toggling
+    QUTIP_CYTHON_SAFE would reuse stale output.  If the directory cannot be
+    created (e.g. the home directory is missing or read-only), the cache is
+    disabled rather than failing the build.
+    """
+    if not options['cython_cache']:
+        return False
+    directives = json.dumps(options['cython_directives'], sort_keys=True)
+    digest = hashlib.sha256(directives.encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.join(options['cython_cache'], digest)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return False
+    return cache_dir
+
+
+def _is_openmp_module(module):
+    """Is the given fully qualified module one of the OpenMP extensions?"""
+    return 'openmp' in module.split('.')[:-1]
+
+
+_OPENMP_TEST_SOURCE = """
+#include <omp.h>
+
+int main(void)
+{
+    int threads = 0;
+    #pragma omp parallel reduction(+:threads)
+    threads += 1;
+    return threads == omp_get_max_threads() ? 0 : 1;
+}
+"""
+
+
+class build_ext(_build_ext):
+    """
+    The setuptools build_ext command, extended to detect whether the compiler
+    supports OpenMP before building the OpenMP extensions.  The 'openmp'
+    attribute is set from the setup script's options: True or False to build
+    or skip the OpenMP extensions unconditionally, or None to test the
+    compiler and skip them (with a warning) if it does not support OpenMP.
+
+    The extensions are already Cythonised by `create_extension_modules`, so we
+    do not need Cython's own build_ext.
+    """
+    def initialize_options(self):
+        super().initialize_options()
+        self.openmp = None
+
+    def build_extensions(self):
+        # Python's own CFLAGS sometimes contain -Wstrict-prototypes, which is
+        # not valid for C++ and makes every compile print a warning that -w
+        # does not suppress.  Remove it from this command's compiler only,
+        # rather than from the shared configuration in sysconfig.
+        compiler_so = getattr(self.compiler, 'compiler_so', None)
+        if compiler_so and '-Wstrict-prototypes' in compiler_so:
+            self.compiler.compiler_so = [
+                flag for flag in compiler_so if flag != '-Wstrict-prototypes'
+            ]
+        if self.openmp is None:
+            openmp_extensions = [
+                extension for extension in self.extensions
+                if _is_openmp_module(extension.name)
+            ]
+            # Only test the compiler if there is something to build; OpenMP
+            # extensions that are already up to date were built by it before.
+            stale_openmp_extensions = [
+                extension for extension in openmp_extensions
+                if self.force or self._is_out_of_date(extension)
+            ]
+            if (
+                stale_openmp_extensions
+                and not self._compiler_supports_openmp(
+                    stale_openmp_extensions[0]
+                )
+            ):
+                warnings.warn(
+                    "the C++ compiler does not support OpenMP;"
+                    " the OpenMP extensions will not be built"
+                )
+                self.extensions = [
+                    extension for extension in self.extensions
+                    if extension not in openmp_extensions
+                ]
+        if not getattr(self, 'parallel', None) or self.force:
+            super().build_extensions()
+            return
+        # In a parallel build, each worker thread checks whether its extension
+        # is out of date, and all those os.stat calls end up serialised on the
+        # GIL anyway.  Do the checks up front in this thread instead, hand only
+        # the stale extensions to the workers, and tell them not to check
+        # again.  Everything is restored afterwards so that `get_outputs`
+        # still reports every extension.
+        extensions = self.extensions
+        self.extensions = [
+            extension for extension in extensions
+            if self._is_out_of_date(extension)
+        ]
+        self.force = True
+        try:
+            super().build_extensions()
+        finally:
+            self.extensions = extensions
+            self.force = False
+
+    def _is_out_of_date(self, extension):
+        """
+        Does the given extension need rebuilding?  This is the same test that
+        `build_extension` does before compiling.
+        """
+        dependencies = list(extension.sources) + list(extension.depends or [])
+        target = self.get_ext_fullpath(extension.name)
+        return newer_group(dependencies, target, 'newer')
+
+    def _compiler_supports_openmp(self, extension):
+        """
+        Test whether a trivial OpenMP program can be compiled and linked with
+        the same flags that will be used to build the given extension.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'openmp_test.cpp')
+            with open(filename, 'w') as file:
+                file.write(_OPENMP_TEST_SOURCE)
+            try:
+                objects = self.compiler.compile(
+                    [filename], output_dir=tmpdir,
+                    extra_postargs=extension.extra_compile_args,
+                )
+                self.compiler.link_executable(
+                    objects, 'openmp_test', output_dir=tmpdir,
+                    extra_postargs=extension.extra_link_args,
+                    target_lang='c++',
+                )
+            except (CompileError, LinkError):
+                return False
+        return True
 
 
 def print_epilogue():
@@ -237,5 +781,9 @@ if __name__ == "__main__":
         version=options['version'],
         ext_modules=extensions,
         cmdclass={'build_ext': build_ext},
+        options={'build_ext': {
+            'parallel': options['jobs'],
+            'openmp': options['openmp'],
+        }},
     )
     print_epilogue()